@@ -1,42 +1,196 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import requests
+from requests.adapters import HTTPAdapter
+from numba import njit
 
 st.set_page_config(page_title="Weather Analysis Dashboard", layout="wide")
 
 BASE_URL = "http://api.openweathermap.org/data/2.5/weather"
 SEASONS = ['winter', 'spring', 'summer', 'autumn']
+MAX_TIMELINE_POINTS = 4000
+DENSITY_PLOT_THRESHOLD = 50_000
 
 
-@st.cache_data
+@st.cache_data(persist="disk", max_entries=8)
 def load_and_prepare_data(uploaded_file):
-    df = pd.read_csv(uploaded_file, parse_dates=['timestamp'])
-    df['year'] = df['timestamp'].dt.year
-    df['month'] = df['timestamp'].dt.month
-    df['day'] = df['timestamp'].dt.day
-    return df
+    df = pd.read_csv(uploaded_file, parse_dates=['timestamp'],
+                     cache_dates=True, engine='pyarrow',
+                     dtype={'city': 'category', 'season': 'category',
+                            'temperature': 'float32'})
+    df['city'] = df['city'].cat.reorder_categories(
+        sorted(df['city'].cat.categories))
+    # Короткий ключ данных для остальных кэшей: хешировать весь df
+    # на каждом перезапуске дороже, чем пересчитать результат.
+    data_key = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+    return df, data_key
+
+
+# fastmath без nnan/ninf: проверки на NaN внутри ядра должны сохраниться.
+@njit(cache=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+def _rolling_mean_std(temps, window_size):
+    # Повторяет rolling(window, center=True).mean()/.std() из pandas:
+    # окно [i - w // 2, i + (w - 1) // 2], NaN там, где окно неполное.
+    n = len(temps)
+    mean = np.full(n, np.nan)
+    std = np.full(n, np.nan)
+    if window_size > n:
+        return mean, std
+
+    left = window_size // 2
+    s = 0.0
+    ss = 0.0
+    nobs = 0
+    for j in range(n):
+        x = temps[j]
+        if not np.isnan(x):
+            s += x
+            ss += x * x
+            nobs += 1
+        if j >= window_size:
+            x = temps[j - window_size]
+            if not np.isnan(x):
+                s -= x
+                ss -= x * x
+                nobs -= 1
+        if j >= window_size - 1 and nobs == window_size:
+            i = j - window_size + 1 + left
+            mean[i] = s / nobs
+            var = (ss - s * s / nobs) / (nobs - 1)
+            std[i] = np.sqrt(var) if var > 0.0 else 0.0
+    return mean, std
+
+
+@st.cache_resource(show_spinner=False)
+def _warmup_rolling_kernel():
+    _rolling_mean_std(np.zeros(4, dtype=np.float32), 2)
+
+
+_warmup_rolling_kernel()
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def prepare_city_data(_df, data_key, city, window_size, compute_anomalies=True):
+    # _df не хешируется, данные определяет data_key.
+    mask = _df['city'].values == city
+    temps = _df['temperature'].values[mask]
+
+    rolling_mean, rolling_std = _rolling_mean_std(temps, window_size)
+    if compute_anomalies:
+        is_anomaly = np.abs(temps - rolling_mean) > 2.0 * rolling_std
+    else:
+        is_anomaly = np.zeros(len(temps), dtype=bool)
+
+    city_data = _df[mask]
+    city_data = city_data.assign(
+        year=city_data['timestamp'].dt.year.astype(np.uint16),
+        month=city_data['timestamp'].dt.month.astype(np.uint8),
+        rolling_mean=rolling_mean,
+        rolling_std=rolling_std,
+        is_anomaly=is_anomaly,
+    )
 
+    return city_data
 
-def prepare_city_data(df, city, window_size):
-    city_data = df[df['city'] == city].copy()
 
-    city_data['rolling_mean'] = city_data['temperature'].rolling(
-        window=window_size, center=True).mean()
-    city_data['rolling_std'] = city_data['temperature'].rolling(
-        window=window_size, center=True).std()
+@njit(cache=True)
+def _lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: из каждой корзины берём точку,
+    # образующую наибольший треугольник с соседними корзинами.
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[n_out - 1] = n - 1
+    bucket_size = (n - 2) / (n_out - 2)
+    a = 0
+    for i in range(n_out - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+
+        avg_x = 0.0
+        avg_y = 0.0
+        for j in range(end, next_end):
+            avg_x += x[j]
+            avg_y += y[j]
+        avg_x /= next_end - end
+        avg_y /= next_end - end
+
+        chosen = start
+        max_area = -1.0
+        for j in range(start, end):
+            area = abs((x[a] - avg_x) * (y[j] - y[a])
+                       - (x[a] - x[j]) * (avg_y - y[a]))
+            if area > max_area:
+                max_area = area
+                chosen = j
+        indices[i + 1] = chosen
+        a = chosen
+    return indices
+
+
+def downsample_timeline(city_data, keep_anomalies):
+    if len(city_data) <= MAX_TIMELINE_POINTS:
+        return city_data
+
+    x = city_data['timestamp'].values.astype(np.int64).astype(np.float64)
+    y = city_data['temperature'].values.astype(np.float64)
+    indices = _lttb_indices(x, y, MAX_TIMELINE_POINTS)
+    if keep_anomalies:
+        indices = np.union1d(indices, np.flatnonzero(city_data['is_anomaly'].values))
+    return city_data.iloc[indices]
+
+
+def temperature_density_trace(city_data, nbinsx=400, nbinsy=80):
+    # Гистограмма считается на сервере, в браузер уходит только сетка.
+    temps = city_data['temperature'].values
+    valid = ~np.isnan(temps)
+    timestamps = city_data['timestamp'].values[valid]
+    counts, x_edges, y_edges = np.histogram2d(
+        timestamps.astype(np.int64), temps[valid], bins=(nbinsx, nbinsy)
+    )
+    x_centers = ((x_edges[:-1] + x_edges[1:]) / 2).astype(np.int64).astype(timestamps.dtype)
+    y_centers = (y_edges[:-1] + y_edges[1:]) / 2
+
+    return go.Heatmap(
+        x=x_centers,
+        y=y_centers,
+        z=np.where(counts > 0, counts, np.nan).T,
+        colorscale='Blues',
+        name='Плотность',
+        colorbar=dict(title='Дней')
+    )
 
-    city_data['is_anomaly'] = abs(
-        city_data['temperature'] - city_data['rolling_mean']
-    ) > 2 * city_data['rolling_std']
 
-    return city_data
+@st.cache_resource
+def _http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-@st.cache_data(ttl=600)
+
+@st.cache_resource
+def _executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+
+@st.cache_data(ttl=600, show_spinner=False)
 def get_current_weather(city, api_key):
+    # Выполняется в фоновом потоке, поэтому ошибки возвращаются, а не
+    # выводятся через st.error.
     if not api_key:
-        return None
+        return None, None
 
     params = {
         'q': city,
@@ -45,42 +199,62 @@ def get_current_weather(city, api_key):
     }
 
     try:
-        response = requests.get(BASE_URL, params=params)
+        response = _http_session().get(BASE_URL, params=params, timeout=5)
         data = response.json()
 
         if response.status_code == 401:
-            st.error("Неверный API ключ. Пожалуйста, проверьте ваш ключ.")
-            return None
+            return None, "Неверный API ключ. Пожалуйста, проверьте ваш ключ."
         elif response.status_code != 200:
-            st.error(f"Ошибка получения данных: {data.get('message', 'Unknown error')}")
-            return None
+            return None, f"Ошибка получения данных: {data.get('message', 'Unknown error')}"
 
-        return data
+        return data, None
     except Exception as e:
-        st.error(f"Ошибка при запросе к API: {str(e)}")
-        return None
+        return None, f"Ошибка при запросе к API: {str(e)}"
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _pivot_for_heatmap(_city_data, data_key, city):
+    # Ключ - данные и город, окно скользящего среднего на тепловую карту не влияет;
+    # срез строится только при промахе кэша.
+    heatmap_data = _city_data[['year', 'month', 'temperature']]
+    pivot_data = heatmap_data.groupby(
+        ['year', 'month'], observed=True
+    )['temperature'].mean().unstack('year').round(1)
+    return pivot_data.to_numpy(), pivot_data.columns.to_numpy(), pivot_data.index.to_numpy()
 
 
-def plot_temperature_heatmap(df, city):
-    city_data = df[df['city'] == city].copy()
-    pivot_data = city_data.pivot_table(
-        index='month',
-        columns='year',
-        values='temperature',
-        aggfunc='mean'
-    ).round(1)
+def plot_temperature_heatmap(city_data, data_key, city):
+    pivot_values, years, months = _pivot_for_heatmap(city_data, data_key, city)
 
-    fig = px.imshow(pivot_data,
+    fig = px.imshow(pivot_values,
+                    x=years,
+                    y=months,
                     labels=dict(x="Год", y="Месяц", color="Температура"),
                     title=f"Тепловая карта температур для {city}")
     return fig
 
 
+@st.cache_data(max_entries=32, show_spinner=False)
+def _city_stats(stats_data):
+    # Считаем в float64: у float32 округление до сотых не видно в таблице.
+    temperature = stats_data['temperature'].astype('float64')
+    stats = temperature.describe().round(2)
+    seasonal_stats = temperature.groupby(stats_data['season'], observed=True).agg([
+        'mean', 'std', 'min', 'max'
+    ]).round(2)
+    return stats, seasonal_stats
+
+
 def plot_anomalies_distribution(city_data):
-    monthly_anomalies = city_data.groupby(['year', 'month'])['is_anomaly'].sum().reset_index()
-    monthly_anomalies['date'] = pd.to_datetime(
-        monthly_anomalies[['year', 'month']].assign(day=1)
-    )
+    # datetime64[M] хранит номер месяца от 1970-01, его и используем как ключ.
+    months = city_data['timestamp'].values.astype('datetime64[M]').astype(np.int64)
+    first_month = months.min()
+    counts = np.bincount(months - first_month, weights=city_data['is_anomaly'].values)
+
+    monthly_anomalies = pd.DataFrame({
+        'date': (first_month + np.arange(len(counts))).astype('datetime64[M]').astype('datetime64[s]'),
+        'is_anomaly': counts.astype(np.int64),
+    })
 
     fig = px.bar(
         monthly_anomalies,
@@ -92,6 +266,68 @@ def plot_anomalies_distribution(city_data):
     return fig
 
 
+def show_current_weather(weather_data, city_data, rolling_window):
+    current_temp = weather_data['main']['temp']
+    current_date = np.datetime64(pd.Timestamp.now())
+
+    timestamps = city_data['timestamp'].values
+    date_diff = np.abs(timestamps - current_date).astype(np.int64)
+    window = min(rolling_window, len(date_diff))
+    closest = np.argpartition(date_diff, window - 1)[:window]
+    closest_dates = timestamps[closest]
+    closest_temps = city_data['temperature'].values[closest]
+
+    # Пропуски в данных не должны превращать норму в NaN.
+    rolling_mean = np.nanmean(closest_temps, dtype=np.float64)
+    rolling_std = np.nanstd(closest_temps, dtype=np.float64, ddof=1)
+
+    is_current_anomaly = abs(current_temp - rolling_mean) > 2 * rolling_std
+    deviation_sigma = abs(current_temp - rolling_mean) / rolling_std
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric(
+            "🌡️ Текущая температура",
+            f"{current_temp:.1f}°C",
+            f"{current_temp - rolling_mean:+.1f}°C от нормы"
+        )
+    with col2:
+        st.metric("💧 Влажность", f"{weather_data['main']['humidity']}%")
+    with col3:
+        st.metric("🌪️ Давление", f"{weather_data['main']['pressure']} hPa")
+
+    st.subheader("Анализ текущей температуры")
+    temperature_status = (
+        "🚨 Аномальная" if is_current_anomaly else "✅ Нормальная"
+    )
+
+    start_date = pd.Timestamp(closest_dates.min()).strftime('%d.%m')
+    end_date = pd.Timestamp(closest_dates.max()).strftime('%d.%m')
+
+    st.markdown(f"""
+    **Статус:** {temperature_status}
+
+    Анализ основан на скользящем окне в {rolling_window} дней:
+    - Период анализа: {start_date} - {end_date}
+    - Средняя температура за период: {rolling_mean:.1f}°C
+    - Отклонение от среднего: {deviation_sigma:.1f}σ
+    - Диапазон нормы: от {rolling_mean - 2 * rolling_std:.1f}°C до {rolling_mean + 2 * rolling_std:.1f}°C
+    """)
+
+    if is_current_anomaly:
+        st.warning(f"""
+        ⚠️ Текущая температура отклоняется от нормы на {deviation_sigma:.1f} 
+        стандартных отклонений (рассчитано на основе {rolling_window}-дневного окна). 
+        Это считается статистически значимым отклонением.
+        """)
+
+        st.info(f"""
+        📊 Дополнительная статистика:
+        - Абсолютное отклонение: {abs(current_temp - rolling_mean):.1f}°C
+        - Стандартное отклонение в периоде: {rolling_std:.1f}°C
+        """)
+
+
 def main():
     st.title('📊 Анализ температурных данных')
 
@@ -105,95 +341,71 @@ def main():
         show_anomalies = st.checkbox("Показывать аномалии", value=True)
         rolling_window = st.slider("Окно скользящего среднего (дни)", 5, 60, 30)
 
+        # Разобранные CSV сохраняются в ~/.streamlit/cache и сами оттуда не удаляются:
+        # max_entries ограничивает только кэш в памяти.
+        if st.button("🗑️ Очистить кэш загруженных файлов"):
+            load_and_prepare_data.clear()
+
     uploaded_file = st.file_uploader("📁 Загрузите файл с историческими данными (CSV)", type=['csv'])
 
     if uploaded_file is not None:
-        df = load_and_prepare_data(uploaded_file)
-        cities = sorted(df['city'].unique())
+        df, data_key = load_and_prepare_data(uploaded_file)
+        cities = df['city'].cat.categories.tolist()
 
         col1, col2 = st.columns([2, 1])
         with col1:
             city = st.selectbox('🌆 Выберите город', cities)
 
         if city:
-            city_data = prepare_city_data(df, city, rolling_window)
-
+            weather_future = None
             if api_key:
-                weather_data = get_current_weather(city, api_key)
-                if weather_data:
-                    current_temp = weather_data['main']['temp']
-                    current_date = pd.Timestamp.now()
-
-                    city_data['date_diff'] = abs(city_data['timestamp'] - current_date)
-                    closest_dates = city_data.nsmallest(rolling_window, 'date_diff')
-
-                    rolling_mean = closest_dates['temperature'].mean()
-                    rolling_std = closest_dates['temperature'].std()
-
-                    is_current_anomaly = abs(current_temp - rolling_mean) > 2 * rolling_std
-                    deviation_sigma = abs(current_temp - rolling_mean) / rolling_std
-
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        st.metric(
-                            "🌡️ Текущая температура",
-                            f"{current_temp:.1f}°C",
-                            f"{current_temp - rolling_mean:+.1f}°C от нормы"
-                        )
-                    with col2:
-                        st.metric("💧 Влажность", f"{weather_data['main']['humidity']}%")
-                    with col3:
-                        st.metric("🌪️ Давление", f"{weather_data['main']['pressure']} hPa")
-
-                    st.subheader("Анализ текущей температуры")
-                    temperature_status = (
-                        "🚨 Аномальная" if is_current_anomaly else "✅ Нормальная"
-                    )
-
-                    start_date = closest_dates['timestamp'].min().strftime('%d.%m')
-                    end_date = closest_dates['timestamp'].max().strftime('%d.%m')
-
-                    st.markdown(f"""
-                    **Статус:** {temperature_status}
-
-                    Анализ основан на скользящем окне в {rolling_window} дней:
-                    - Период анализа: {start_date} - {end_date}
-                    - Средняя температура за период: {rolling_mean:.1f}°C
-                    - Отклонение от среднего: {deviation_sigma:.1f}σ
-                    - Диапазон нормы: от {rolling_mean - 2 * rolling_std:.1f}°C до {rolling_mean + 2 * rolling_std:.1f}°C
-                    """)
-
-                    if is_current_anomaly:
-                        st.warning(f"""
-                        ⚠️ Текущая температура отклоняется от нормы на {deviation_sigma:.1f} 
-                        стандартных отклонений (рассчитано на основе {rolling_window}-дневного окна). 
-                        Это считается статистически значимым отклонением.
-                        """)
-
-                        st.info(f"""
-                        📊 Дополнительная статистика:
-                        - Абсолютное отклонение: {abs(current_temp - rolling_mean):.1f}°C
-                        - Стандартное отклонение в периоде: {rolling_std:.1f}°C
-                        """)
+                weather_future = _executor().submit(get_current_weather, city, api_key)
 
+            city_data = prepare_city_data(df, data_key, city, rolling_window, show_anomalies)
+            weather_section = st.container()
 
             tab1, tab2, tab3 = st.tabs(["📈 Временной ряд", "🗺️ Тепловая карта", "📊 Аномалии"])
 
             with tab1:
-                fig_timeline = px.scatter(
-                    city_data,
-                    x='timestamp',
-                    y='temperature',
-                    color='is_anomaly' if show_anomalies else None,
-                    title=f'Температурный ряд для {city}',
-                    color_discrete_map={True: 'red', False: 'blue'}
-                )
+                timeline_data = downsample_timeline(city_data, show_anomalies)
+
+                if len(city_data) > DENSITY_PLOT_THRESHOLD:
+                    fig_timeline = go.Figure(temperature_density_trace(city_data))
+                    if show_anomalies:
+                        anomalies = city_data[city_data['is_anomaly']]
+                        fig_timeline.add_trace(
+                            go.Scattergl(
+                                x=anomalies['timestamp'],
+                                y=anomalies['temperature'],
+                                mode='markers',
+                                name='Аномалии',
+                                marker=dict(color='red')
+                            )
+                        )
+                else:
+                    marker_color = (
+                        np.where(timeline_data['is_anomaly'], 'red', 'blue')
+                        if show_anomalies else None
+                    )
+                    fig_timeline = go.Figure(
+                        go.Scattergl(
+                            x=timeline_data['timestamp'],
+                            y=timeline_data['temperature'],
+                            mode='markers',
+                            name='Температура',
+                            marker=dict(color=marker_color)
+                        )
+                    )
+                fig_timeline.update_layout(title=f'Температурный ряд для {city}')
 
                 if show_trend:
+                    rolling_mean = timeline_data['rolling_mean'].values
+                    two_sigma = 2.0 * timeline_data['rolling_std'].values
+
                     fig_timeline.add_trace(
                         go.Scatter(
-                            x=city_data['timestamp'],
-                            y=city_data['rolling_mean'],
+                            x=timeline_data['timestamp'],
+                            y=rolling_mean,
                             mode='lines',
                             name=f'{rolling_window}-дневное среднее',
                             line=dict(color='green', width=2)
@@ -202,8 +414,8 @@ def main():
 
                     fig_timeline.add_trace(
                         go.Scatter(
-                            x=city_data['timestamp'],
-                            y=city_data['rolling_mean'] + 2 * city_data['rolling_std'],
+                            x=timeline_data['timestamp'],
+                            y=rolling_mean + two_sigma,
                             mode='lines',
                             name='Верхняя граница (2σ)',
                             line=dict(color='rgba(255,165,0,0.5)', width=1, dash='dash')
@@ -211,8 +423,8 @@ def main():
                     )
                     fig_timeline.add_trace(
                         go.Scatter(
-                            x=city_data['timestamp'],
-                            y=city_data['rolling_mean'] - 2 * city_data['rolling_std'],
+                            x=timeline_data['timestamp'],
+                            y=rolling_mean - two_sigma,
                             mode='lines',
                             name='Нижняя граница (2σ)',
                             line=dict(color='rgba(255,165,0,0.5)', width=1, dash='dash'),
@@ -239,38 +451,53 @@ def main():
                 st.plotly_chart(fig_timeline, use_container_width=True)
 
             with tab2:
-                fig_heatmap = plot_temperature_heatmap(df, city)
+                fig_heatmap = plot_temperature_heatmap(city_data, data_key, city)
                 st.plotly_chart(fig_heatmap, use_container_width=True)
 
             with tab3:
-                fig_anomalies = plot_anomalies_distribution(city_data)
-                st.plotly_chart(fig_anomalies, use_container_width=True)
+                if show_anomalies:
+                    fig_anomalies = plot_anomalies_distribution(city_data)
+                    st.plotly_chart(fig_anomalies, use_container_width=True)
+                else:
+                    st.info("Поиск аномалий отключён в настройках.")
 
             st.header("📊 Статистический анализ")
+            stats, seasonal_stats = _city_stats(city_data[['temperature', 'season']])
             col1, col2 = st.columns(2)
 
             with col1:
                 st.subheader("Описательная статистика")
-                stats = city_data['temperature'].describe().round(2)
                 st.dataframe(stats)
 
             with col2:
                 st.subheader("Сезонная статистика")
-                seasonal_stats = city_data.groupby('season')['temperature'].agg([
-                    'mean', 'std', 'min', 'max'
-                ]).round(2)
                 st.dataframe(seasonal_stats)
 
             st.header("❗ Анализ аномалий")
-            total_anomalies = city_data['is_anomaly'].sum()
-            total_days = len(city_data)
-            anomaly_percentage = (total_anomalies / total_days) * 100
-
-            col1, col2 = st.columns(2)
-            with col1:
-                st.metric("Количество аномалий", f"{int(total_anomalies)}")
-            with col2:
-                st.metric("Процент аномалий", f"{anomaly_percentage:.1f}%")
+            if show_anomalies:
+                total_anomalies = city_data['is_anomaly'].sum()
+                total_days = len(city_data)
+                anomaly_percentage = (total_anomalies / total_days) * 100
+
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.metric("Количество аномалий", f"{int(total_anomalies)}")
+                with col2:
+                    st.metric("Процент аномалий", f"{anomaly_percentage:.1f}%")
+            else:
+                st.info("Поиск аномалий отключён в настройках.")
+
+            if weather_future is not None:
+                with weather_section:
+                    try:
+                        weather_data, error = weather_future.result(timeout=10)
+                    except FutureTimeoutError:
+                        weather_data, error = None, "Превышено время ожидания ответа API."
+
+                    if error:
+                        st.error(error)
+                    elif weather_data:
+                        show_current_weather(weather_data, city_data, rolling_window)
 
 
 if __name__ == '__main__':
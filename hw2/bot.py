@@ -1,9 +1,14 @@
 import asyncio
+import contextlib
 import aiohttp
-import matplotlib.pyplot as plt
+import numpy as np
+import orjson
 import io
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field, fields
+from types import MappingProxyType
 from datetime import datetime
-import uuid
 import os
 from dotenv import load_dotenv
 
@@ -11,12 +16,79 @@ from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import BotCommand
-from rapidfuzz import process
-from aiogram.utils.keyboard import InlineKeyboardBuilder
-
-
-users = {}
+from aiogram.fsm.storage.redis import RedisStorage
+from aiogram.types import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
+from rapidfuzz import fuzz, process
+from redis.asyncio import Redis
+
+
+temperature_tasks: dict[int, asyncio.Task] = {}
+temperature_cache: OrderedDict[str, tuple[float, float]] = OrderedDict()
+food_cache: OrderedDict[tuple[str, int], list[dict]] = OrderedDict()
+session: aiohttp.ClientSession | None = None
+# (user_id, журнал, счётчик, значение, доп. приращения, время в нс)
+log_buffer: deque[tuple[int, str, str, float, dict[str, float], int]] = deque()
+log_flush_lock = asyncio.Lock()
+# Растёт при каждом начале записи буфера, по нему читатель замечает гонку с записью
+log_flush_epoch = 0
+
+class TimeSeries:
+    # Журнал в виде двух массивов (время в нс UTC, значение) с удвоением ёмкости
+    __slots__ = ("_timestamps", "_values", "size")
+
+    def __init__(self, capacity: int = 16):
+        self._timestamps = np.empty(capacity, dtype=np.int64)
+        self._values = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, timestamp_ns: int, value: float):
+        if self.size == len(self._values):
+            capacity = 2 * len(self._values)
+            timestamps = np.empty(capacity, dtype=self._timestamps.dtype)
+            values = np.empty(capacity, dtype=self._values.dtype)
+            timestamps[:self.size] = self._timestamps
+            values[:self.size] = self._values
+            self._timestamps = timestamps
+            self._values = values
+        self._timestamps[self.size] = timestamp_ns
+        self._values[self.size] = value
+        self.size += 1
+
+    @classmethod
+    def from_entries(cls, entries: list[str]) -> "TimeSeries":
+        series = cls(max(len(entries), 16))
+        for entry in entries:
+            timestamp_ns, value = entry.split(":", 1)
+            series.append(int(timestamp_ns), float(value))
+        return series
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps[:self.size].view("datetime64[ns]")
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._values[:self.size]
+
+@dataclass(slots=True)
+class UserState:
+    weight: float
+    height: float
+    age: int
+    activity: int
+    city: str
+    temp: float
+    water_goal: float
+    calorie_goal: float
+    logged_water: float = 0
+    logged_calories: float = 0
+    burned_calories: float = 0
+    water_logs: TimeSeries = field(default_factory=TimeSeries)
+    food_logs: TimeSeries = field(default_factory=TimeSeries)
+    workout_logs: TimeSeries = field(default_factory=TimeSeries)
 
 class ProfileStates(StatesGroup):
     weight = State()
@@ -33,105 +105,264 @@ class FoodLogStates(StatesGroup):
 
 load_dotenv()
 
+# Переменные окружения (.env): BOT_TOKEN, OPENWEATHER_API_KEY и REDIS_URL.
+# Профили, журналы и состояния диалогов хранятся в Redis, без него бот не работает.
 API_TOKEN = os.getenv("BOT_TOKEN")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+TEMPERATURE_TTL = 600
+TEMPERATURE_CACHE_SIZE = 1024
+FOOD_CACHE_SIZE = 1024
+FOOD_SCORE_CUTOFF = 60
+GRAPH_DPI = 80
+LOG_FLUSH_INTERVAL = 5
+WORKOUT_FACTORS = MappingProxyType({
+    "бег": 10,
+    "ходьба": 4,
+    "силовая": 8,
+    "велосипед": 7,
+})
+LOG_NAMES = ("water_logs", "food_logs", "workout_logs")
+PROFILE_FIELDS = tuple(f for f in fields(UserState) if f.name not in LOG_NAMES)
+
+redis = Redis.from_url(REDIS_URL, decode_responses=True)
 bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+# У FSM свой клиент: start_polling закрывает хранилище при остановке раньше,
+# чем main() допишет буфер журналов через redis.
+dp = Dispatcher(storage=RedisStorage.from_url(REDIS_URL))
+
+# Профиль хранится в хеше user:<id>, журналы - в списках user:<id>:<журнал>
+# с элементами вида "<время в нс>:<значение>".
+def user_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+async def user_exists(user_id: int) -> bool:
+    return bool(await redis.exists(user_key(user_id)))
+
+async def save_user(user_id: int, user: UserState):
+    # Накопленные записи должны попасть в Redis до сброса журналов
+    await flush_logs()
+    key = user_key(user_id)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(key, *(f"{key}:{name}" for name in LOG_NAMES))
+        pipe.hset(key, mapping={f.name: getattr(user, f.name) for f in PROFILE_FIELDS})
+        await pipe.execute()
+
+async def load_user(user_id: int, with_logs: bool = False) -> UserState | None:
+    key = user_key(user_id)
+    while True:
+        # Ждём только уже начатую запись буфера, сами ничего не записываем
+        if log_flush_lock.locked():
+            async with log_flush_lock:
+                pass
+        epoch = log_flush_epoch
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(key)
+            if with_logs:
+                for name in LOG_NAMES:
+                    pipe.lrange(f"{key}:{name}", 0, -1)
+            profile, *logs = await pipe.execute()
+        # Если за время чтения началась запись буфера, часть записей могла
+        # уже попасть в Redis и уйти из буфера - читаем заново
+        if epoch == log_flush_epoch:
+            break
+
+    if not profile:
+        return None
+    user = UserState(**{f.name: f.type(profile[f.name]) for f in PROFILE_FIELDS})
+    for name, entries in zip(LOG_NAMES, logs):
+        setattr(user, name, TimeSeries.from_entries(entries))
+
+    # Добавляем ещё не записанные события пользователя, чтобы он видел свои последние записи
+    for event_user_id, log_name, counter, value, increments, timestamp_ns in log_buffer:
+        if event_user_id != user_id:
+            continue
+        setattr(user, counter, getattr(user, counter) + value)
+        for name, amount in increments.items():
+            setattr(user, name, getattr(user, name) + amount)
+        if with_logs:
+            getattr(user, log_name).append(timestamp_ns, value)
+    return user
+
+def log_event(user_id: int, log_name: str, counter: str, value: float, **increments: float):
+    # Запись только попадает в буфер, в Redis её отправит flush_logs
+    log_buffer.append((user_id, log_name, counter, value, increments, time.time_ns()))
+
+async def flush_logs():
+    global log_flush_epoch
+    async with log_flush_lock:
+        if not log_buffer:
+            return
+        log_flush_epoch += 1
+        events = [log_buffer.popleft() for _ in range(len(log_buffer))]
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                for user_id, log_name, counter, value, increments, timestamp_ns in events:
+                    key = user_key(user_id)
+                    pipe.hincrbyfloat(key, counter, value)
+                    for name, amount in increments.items():
+                        pipe.hincrbyfloat(key, name, amount)
+                    pipe.rpush(f"{key}:{log_name}", f"{timestamp_ns}:{value}")
+                await pipe.execute()
+        except BaseException:
+            # Возвращаем записи в начало буфера, чтобы не потерять их и сохранить порядок,
+            # в том числе при отмене задачи во время записи
+            log_buffer.extendleft(reversed(events))
+            raise
+
+async def flush_logs_periodically():
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        try:
+            await flush_logs()
+        except Exception as e:
+            print(f"Ошибка записи журналов в Redis: {e}")
+
+def cache_temperature(city_key: str, temp: float):
+    temperature_cache[city_key] = (time.monotonic() + TEMPERATURE_TTL, temp)
+    temperature_cache.move_to_end(city_key)
+    if len(temperature_cache) > TEMPERATURE_CACHE_SIZE:
+        temperature_cache.popitem(last=False)
 
 async def get_temperature(city: str) -> float:
+    city_key = city.strip().lower()
+    cached = temperature_cache.get(city_key)
+    if cached is not None:
+        if time.monotonic() < cached[0]:
+            temperature_cache.move_to_end(city_key)
+            return cached[1]
+        del temperature_cache[city_key]
+
     openweather_api_key = os.getenv("OPENWEATHER_API_KEY")
     url = "http://api.openweathermap.org/data/2.5/weather"
-    async with aiohttp.ClientSession() as session:
-        try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-                "Accept": "application/json",
-            }
-
-            params = {
-                'q': city,
-                'appid': openweather_api_key,
-                'units': 'metric'
-            }
-
-            async with session.get(url, params=params, headers=headers) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    print(f"Ошибка получения погоды: {response.status}, {error_text}, url='{url}'")
-                    return 15.0
-
-                data = await response.json(content_type=None)
-                if data.get("main"):
-                    return data["main"]["temp"]
-                else:
-                    return 15.0
-        except Exception as e:
-            print(f"Ошибка получения погоды: {e}")
-            return 20.0
+    try:
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+            "Accept": "application/json",
+        }
+
+        params = {
+            'q': city,
+            'appid': openweather_api_key,
+            'units': 'metric'
+        }
+
+        async with session.get(url, params=params, headers=headers) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                print(f"Ошибка получения погоды: {response.status}, {error_text}, url='{url}'")
+                return 15.0
+
+            data = orjson.loads(await response.read())
+            if data.get("main"):
+                temp = data["main"]["temp"]
+                cache_temperature(city_key, temp)
+                return temp
+            else:
+                return 15.0
+    except Exception as e:
+        print(f"Ошибка получения погоды: {e}")
+        return 20.0
+
+# Разбор чисел без исключений: некорректный ввод отсекается проверкой строки
+def parse_float(text: str | None) -> float | None:
+    text = (text or "").strip()
+    if not text.removeprefix("-").replace(".", "", 1).isdecimal():
+        return None
+    return float(text)
+
+def parse_int(text: str | None) -> int | None:
+    text = (text or "").strip()
+    if not text.removeprefix("-").isdecimal():
+        return None
+    return int(text)
+
+def prefetch_temperature(user_id: int, city: str):
+    task = asyncio.create_task(get_temperature(city))
+    temperature_tasks[user_id] = task
+
+    # Завершённую задачу не храним: удачный ответ уже лежит в temperature_cache,
+    # а пользователь может и не дойти до следующего шага
+    def forget(done_task: asyncio.Task):
+        if temperature_tasks.get(user_id) is done_task:
+            del temperature_tasks[user_id]
+
+    task.add_done_callback(forget)
+
+def cache_food_candidates(key: tuple[str, int], candidates: list[dict]):
+    food_cache[key] = candidates
+    food_cache.move_to_end(key)
+    if len(food_cache) > FOOD_CACHE_SIZE:
+        food_cache.popitem(last=False)
 
 async def get_food_candidates(food_name: str, limit: int = 5):
+    cache_key = (food_name.strip().lower(), limit)
+    cached = food_cache.get(cache_key)
+    if cached is not None:
+        food_cache.move_to_end(cache_key)
+        return [dict(candidate) for candidate in cached]
+
     url = "https://world.openfoodfacts.org/cgi/search.pl"
     params = {
         "search_terms": food_name,
         "search_simple": 1,
         "action": "process",
         "json": 1,
-        "page_size": 20
+        "page_size": 20,
+        "fields": "product_name,nutriments"
     }
     results = []
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, params=params) as response:
-                data = await response.json()
-                products = data.get("products", [])
-                for prod in products:
-                    if not isinstance(prod, dict):
-                        continue
-                    nutriments = prod.get("nutriments", {})
-                    cal = nutriments.get("energy-kcal_100g")
-                    if cal is None:
-                        cal = nutriments.get("energy-kcal")
-                    if cal is not None:
-                        product_name = prod.get("product_name", "").strip()
-                        if product_name:
-                            results.append({
-                                "name": product_name,
-                                "calories": float(cal)
-                            })
-        except Exception as e:
-            print(f"Ошибка при получении данных о продукте: {e}")
+    try:
+        async with session.get(url, params=params) as response:
+            data = orjson.loads(await response.read())
+            products = data.get("products", [])
+            for prod in products:
+                nutriments = prod.get("nutriments", {})
+                cal = nutriments.get("energy-kcal_100g")
+                if cal is None:
+                    cal = nutriments.get("energy-kcal")
+                if cal is not None:
+                    product_name = prod.get("product_name", "").strip()
+                    if product_name:
+                        results.append({
+                            "name": product_name,
+                            "calories": float(cal)
+                        })
+    except Exception as e:
+        print(f"Ошибка при получении данных о продукте: {e}")
 
     if not results:
         return []
 
-    cleaned_results = []
-    for i, item in enumerate(results):
-        if isinstance(item, dict) and "name" in item and isinstance(item["name"], str):
-            cleaned_results.append(item)
-
-    def safe_processor(x):
-        if isinstance(x, dict) and "name" in x and isinstance(x["name"], str):
-            return x["name"]
-        return ""
-
-    fuzzy_matches = process.extract(
-        food_name,
-        cleaned_results,
-        processor=safe_processor,
-        limit=limit
-    )
-
-    final_list = []
-    for match_data, score, _ in fuzzy_matches:
-        if isinstance(match_data, dict):
-            final_list.append({
-                "name": match_data["name"],
-                "calories": match_data["calories"],
-                "score": score
-            })
-
-    final_list.sort(key=lambda x: x["score"], reverse=True)
-    return final_list
+    # Если запрос целиком входит в достаточное число названий, нечёткий поиск не нужен
+    query = food_name.strip().lower()
+    substring_matches = [item for item in results if query in item["name"].lower()]
+    if len(substring_matches) >= limit:
+        final_list = [{**item, "score": 100.0} for item in substring_matches[:limit]]
+        cache_food_candidates(cache_key, final_list)
+        return [dict(candidate) for candidate in final_list]
+
+    names = [item["name"] for item in results]
+    scores = (await asyncio.to_thread(
+        process.cdist,
+        [food_name],
+        names,
+        scorer=fuzz.WRatio,
+        score_cutoff=FOOD_SCORE_CUTOFF,
+        workers=-1
+    ))[0]
+
+    top_count = min(limit, len(scores))
+    top = np.argpartition(-scores, top_count - 1)[:top_count]
+    top = top[np.lexsort((top, -scores[top]))]
+
+    final_list = [
+        {**results[index], "score": float(scores[index])}
+        for index in top
+        if scores[index] >= FOOD_SCORE_CUTOFF
+    ]
+    cache_food_candidates(cache_key, final_list)
+    return [dict(candidate) for candidate in final_list]
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -142,52 +373,59 @@ async def cmd_start(message: types.Message):
 
 @dp.message(Command("set_profile"))
 async def set_profile(message: types.Message, state: FSMContext):
+    # Погода, запрошенная в прошлой незаконченной настройке, больше не нужна
+    temperature_tasks.pop(message.from_user.id, None)
     await message.answer("Введите ваш вес (в кг):")
     await state.set_state(ProfileStates.weight)
 
 @dp.message(ProfileStates.weight)
 async def process_weight(message: types.Message, state: FSMContext):
-    try:
-        weight = float(message.text)
-        await state.update_data(weight=weight)
-        await message.answer("Введите ваш рост (в см):")
-        await state.set_state(ProfileStates.height)
-    except ValueError:
+    weight = parse_float(message.text)
+    if weight is None:
         await message.answer("Пожалуйста, введите число для веса.")
+        return
+    await state.update_data(weight=weight)
+    await message.answer("Введите ваш рост (в см):")
+    await state.set_state(ProfileStates.height)
 
 @dp.message(ProfileStates.height)
 async def process_height(message: types.Message, state: FSMContext):
-    try:
-        height = float(message.text)
-        await state.update_data(height=height)
-        await message.answer("Введите ваш возраст:")
-        await state.set_state(ProfileStates.age)
-    except ValueError:
+    height = parse_float(message.text)
+    if height is None:
         await message.answer("Пожалуйста, введите число для роста.")
+        return
+    await state.update_data(height=height)
+    await message.answer("Введите ваш возраст:")
+    await state.set_state(ProfileStates.age)
 
 @dp.message(ProfileStates.age)
 async def process_age(message: types.Message, state: FSMContext):
-    try:
-        age = int(message.text)
-        await state.update_data(age=age)
-        await message.answer("Сколько минут активности у вас в день?")
-        await state.set_state(ProfileStates.activity)
-    except ValueError:
+    age = parse_int(message.text)
+    if age is None:
         await message.answer("Пожалуйста, введите число для возраста.")
+        return
+    await state.update_data(age=age)
+    await message.answer("Сколько минут активности у вас в день?")
+    await state.set_state(ProfileStates.activity)
 
 @dp.message(ProfileStates.activity)
 async def process_activity(message: types.Message, state: FSMContext):
-    try:
-        activity = int(message.text)
-        await state.update_data(activity=activity)
-        await message.answer("В каком городе вы находитесь?")
-        await state.set_state(ProfileStates.city)
-    except ValueError:
+    activity = parse_int(message.text)
+    if activity is None:
         await message.answer("Пожалуйста, введите число для минут активности.")
+        return
+    await state.update_data(activity=activity)
+    await message.answer("В каком городе вы находитесь?")
+    await state.set_state(ProfileStates.city)
 
 @dp.message(ProfileStates.city)
 async def process_city(message: types.Message, state: FSMContext):
-    city = message.text
+    city = (message.text or "").strip()
+    if not city:
+        await message.answer("Пожалуйста, введите название города текстом.")
+        return
+    # Запрашиваем погоду сразу, пока пользователь вводит цель по калориям
+    prefetch_temperature(message.from_user.id, city)
     await state.update_data(city=city)
     await message.answer("Введите вашу цель по калориям или слово 'авто' для автоматического расчёта:")
     await state.set_state(ProfileStates.calorie_goal)
@@ -199,10 +437,9 @@ async def process_calorie_goal(message: types.Message, state: FSMContext):
     if calorie_goal_input == "авто":
         manual_goal = False
     else:
-        try:
-            calorie_goal_value = float(calorie_goal_input)
-            manual_goal = True
-        except ValueError:
+        calorie_goal_value = parse_float(calorie_goal_input)
+        manual_goal = True
+        if calorie_goal_value is None:
             await message.answer("Пожалуйста, введите число для цели по калориям или отправьте слово 'авто'.")
             return
     weight = data.get("weight")
@@ -211,7 +448,11 @@ async def process_calorie_goal(message: types.Message, state: FSMContext):
     activity = data.get("activity")
     city = data.get("city")
     
-    temp = await get_temperature(city)
+    temperature_task = temperature_tasks.pop(message.from_user.id, None)
+    if temperature_task is not None:
+        temp = await temperature_task
+    else:
+        temp = await get_temperature(city)
     
     # Расчет нормы воды:
     # Базовая норма = вес * 30 мл + 500 мл за каждые 30 мин активности + (500 мл, если температура >25°C)
@@ -227,22 +468,16 @@ async def process_calorie_goal(message: types.Message, state: FSMContext):
         calorie_goal_value = base_calories + activity_bonus
     
     user_id = message.from_user.id
-    users[user_id] = {
-        "weight": weight,
-        "height": height,
-        "age": age,
-        "activity": activity,
-        "city": city,
-        "temp": temp,
-        "water_goal": water_goal,
-        "calorie_goal": calorie_goal_value,
-        "logged_water": 0,
-        "logged_calories": 0,
-        "burned_calories": 0,
-        "water_logs": [],
-        "food_logs": [],
-        "workout_logs": [],
-    }
+    await save_user(user_id, UserState(
+        weight=weight,
+        height=height,
+        age=age,
+        activity=activity,
+        city=city,
+        temp=temp,
+        water_goal=water_goal,
+        calorie_goal=calorie_goal_value,
+    ))
     
     await message.answer(
         f"Профиль сохранён!\n"
@@ -255,7 +490,8 @@ async def process_calorie_goal(message: types.Message, state: FSMContext):
 @dp.message(Command("log_water"))
 async def log_water(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in users:
+    user = await load_user(user_id)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью /set_profile.")
         return
 
@@ -264,15 +500,13 @@ async def log_water(message: types.Message):
     if len(parts) < 2:
         await message.answer("Используйте команду: /log_water <количество_мл>")
         return
-    try:
-        amount = float(parts[1])
-    except ValueError:
+    amount = parse_float(parts[1])
+    if amount is None:
         await message.answer("Пожалуйста, введите число для количества воды.")
         return
 
-    users[user_id]["logged_water"] += amount
-    users[user_id]["water_logs"].append((datetime.now(), amount))
-    remaining = users[user_id]["water_goal"] - users[user_id]["logged_water"]
+    log_event(user_id, "water_logs", "logged_water", amount)
+    remaining = user.water_goal - (user.logged_water + amount)
     if remaining < 0:
         remaining = 0
     await message.answer(f"Записано: {amount} мл воды.\nОсталось: {remaining:.0f} мл.")
@@ -281,7 +515,7 @@ async def log_water(message: types.Message):
 @dp.message(Command("log_food"))
 async def log_food_start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id not in users:
+    if not await user_exists(user_id):
         await message.answer("Сначала настройте профиль с помощью /set_profile.")
         return
 
@@ -300,28 +534,17 @@ async def log_food_start(message: types.Message, state: FSMContext):
         await state.update_data(food_name=food_name)
         return
 
-    builder = InlineKeyboardBuilder()
-
-    candidates_dict = {}
-    for candidate in candidates:
-        candidate_id = str(uuid.uuid4())[:8]
-        candidates_dict[candidate_id] = candidate
-
-        name_short = candidate["name"][:20]
-        btn_text = f"{name_short} ({candidate['calories']:.1f} ккал/100г)"
-
-        callback_data = f"choose_food_{candidate_id}"
-
-        builder.button(text=btn_text, callback_data=callback_data)
-
-    builder.button(text="Ввести калорийность вручную", callback_data="choose_food_manual")
-
-    builder.adjust(1)
-    keyboard = builder.as_markup()
+    rows = [
+        [InlineKeyboardButton(
+            text=f"{candidate['name'][:20]} ({candidate['calories']:.1f} ккал/100г)",
+            callback_data=f"choose_food_{index}"
+        )]
+        for index, candidate in enumerate(candidates)
+    ]
+    rows.append([InlineKeyboardButton(text="Ввести калорийность вручную", callback_data="choose_food_manual")])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=rows)
 
-    data = await state.get_data()
-    data["candidates_dict"] = candidates_dict
-    await state.update_data(data)
+    await state.update_data(candidates=candidates)
 
     await message.answer("Найдены похожие продукты", reply_markup=keyboard)
     await state.set_state(FoodLogStates.waiting_for_product_choice)
@@ -337,15 +560,15 @@ async def choose_food_callback(callback: types.CallbackQuery, state: FSMContext)
         await callback.answer("Некорректный выбор.")
         return
 
-    candidate_id = callback.data.replace("choose_food_", "")
+    candidate_index = callback.data.removeprefix("choose_food_")
 
     data = await state.get_data()
-    candidates_dict = data.get("candidates_dict", {})
+    candidates = data.get("candidates", [])
 
-    chosen_candidate = candidates_dict.get(candidate_id)
-    if not chosen_candidate:
+    if not candidate_index.isdecimal() or int(candidate_index) >= len(candidates):
         await callback.answer("Некорректный выбор.")
         return
+    chosen_candidate = candidates[int(candidate_index)]
 
     cal_per_100g = chosen_candidate["calories"]
     food_name = chosen_candidate["name"]
@@ -359,11 +582,8 @@ async def choose_food_callback(callback: types.CallbackQuery, state: FSMContext)
 
 @dp.message(FoodLogStates.waiting_for_manual_cal)
 async def set_manual_calories(message: types.Message, state: FSMContext):
-    try:
-        custom_cal = float(message.text)
-        if custom_cal <= 0:
-            raise ValueError
-    except ValueError:
+    custom_cal = parse_float(message.text)
+    if custom_cal is None or custom_cal <= 0:
         await message.answer("Пожалуйста, введите положительное число для калорийности.")
         return
 
@@ -374,16 +594,13 @@ async def set_manual_calories(message: types.Message, state: FSMContext):
 @dp.message(FoodLogStates.waiting_for_grams)
 async def log_food_grams(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    if user_id not in users:
+    if not await user_exists(user_id):
         await message.answer("Сначала настройте профиль с помощью /set_profile.")
         await state.clear()
         return
 
-    try:
-        grams = float(message.text)
-        if grams <= 0:
-            raise ValueError
-    except ValueError:
+    grams = parse_float(message.text)
+    if grams is None or grams <= 0:
         await message.answer("Пожалуйста, введите положительное число для граммов.")
         return
 
@@ -397,8 +614,7 @@ async def log_food_grams(message: types.Message, state: FSMContext):
         return
 
     calories_consumed = cal_per_100g * grams / 100.0
-    users[user_id]["logged_calories"] += calories_consumed
-    users[user_id]["food_logs"].append((datetime.now(), calories_consumed))
+    log_event(user_id, "food_logs", "logged_calories", calories_consumed)
 
     await message.answer(f"Записано: {calories_consumed:.1f} ккал (продукт: {food_name}).")
     await state.clear()
@@ -406,7 +622,7 @@ async def log_food_grams(message: types.Message, state: FSMContext):
 @dp.message(Command("log_workout"))
 async def log_workout(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in users:
+    if not await user_exists(user_id):
         await message.answer("Сначала настройте профиль с помощью /set_profile.")
         return
     args = message.text.split()
@@ -416,35 +632,22 @@ async def log_workout(message: types.Message):
             "Поддерживаемые типы тренировки: бег, ходьба, силовая, велосипед"
             )
         return
-    
-    factors = {
-        "бег": 10,
-        "ходьба": 4,
-        "силовая": 8,
-        "велосипед": 7,
-    }
-    
-    workout_type = args[1]
 
-    if workout_type not in factors:
+    workout_type = args[1].lower()
+    factor = WORKOUT_FACTORS.get(workout_type)
+
+    if factor is None:
         await message.answer("Пожалуйста, введите поддерживаемый тип тренировки.")
         return
 
-    try:
-        minutes = float(args[2])
-
-    except ValueError:
+    minutes = parse_float(args[2])
+    if minutes is None:
         await message.answer("Пожалуйста, введите число для времени тренировки.")
         return
 
-
-    factor = factors.get(workout_type.lower(), 6)
     burned = factor * minutes
-    users[user_id]["burned_calories"] += burned
-    users[user_id]["workout_logs"].append((datetime.now(), burned))
-
     extra_water = (minutes // 30) * 200
-    users[user_id]["water_goal"] += extra_water
+    log_event(user_id, "workout_logs", "burned_calories", burned, water_goal=extra_water)
     await message.answer(
         f"🏃‍♂️ {workout_type} {minutes:.0f} минут — {burned:.0f} ккал сожжено.\n"
         f"Дополнительно: выпейте {int(extra_water)} мл воды."
@@ -453,17 +656,17 @@ async def log_workout(message: types.Message):
 @dp.message(Command("check_progress"))
 async def check_progress(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in users:
+    user = await load_user(user_id)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью /set_profile.")
         return
     
-    data = users[user_id]
-    water_goal = data["water_goal"]
-    logged_water = data["logged_water"]
+    water_goal = user.water_goal
+    logged_water = user.logged_water
     remaining_water = water_goal - logged_water if water_goal > logged_water else 0
-    calorie_goal = data["calorie_goal"]
-    logged_calories = data["logged_calories"]
-    burned_calories = data["burned_calories"]
+    calorie_goal = user.calorie_goal
+    logged_calories = user.logged_calories
+    burned_calories = user.burned_calories
     net_calories = logged_calories - burned_calories
     msg = (
         f"📊 Прогресс:\n\n"
@@ -483,75 +686,84 @@ async def check_progress(message: types.Message):
     await message.answer(msg + recommendations)
 
 
+def render_progress_png(times, values, goal, *, label, goal_label, ylabel, title) -> bytes:
+    # Вызывается из отдельного потока, поэтому фигура создаётся напрямую, без pyplot
+    # и его глобального списка фигур; png рисуется через Agg без выбора бэкенда.
+    # matplotlib импортируется лениво: он нужен только для /show_graph.
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 5), dpi=GRAPH_DPI)
+    ax = fig.subplots()
+    ax.plot(times, values, marker="o", label=label)
+    ax.axhline(y=goal, color="r", linestyle="--", label=goal_label)
+    ax.set_xlabel("Время")
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.legend()
+
+    buf = io.BytesIO()
+    fig.savefig(
+        buf,
+        format="png",
+        dpi=GRAPH_DPI,
+        bbox_inches=None,
+        pil_kwargs={"optimize": False, "compress_level": 1},
+    )
+    return buf.getvalue()
+
 @dp.message(Command("show_graph"))
 async def show_graph(message: types.Message):
     user_id = message.from_user.id
-    if user_id not in users:
+    user = await load_user(user_id, with_logs=True)
+    if user is None:
         await message.answer("Сначала настройте профиль с помощью /set_profile.")
         return
 
-    data = users[user_id]
-    water_logs = data.get("water_logs", [])
-    food_logs = data.get("food_logs", [])
-    workout_logs = data.get("workout_logs", [])
+    water_logs = user.water_logs
+    food_logs = user.food_logs
+    workout_logs = user.workout_logs
+    # Время в журналах хранится в UTC, на графиках показываем местное
+    utc_offset = np.timedelta64(int(datetime.now().astimezone().utcoffset().total_seconds()), "s")
 
     if water_logs:
-        times_water = [log[0] for log in water_logs]
-        amounts = [log[1] for log in water_logs]
-        cum_water = []
-        total = 0
-        for amt in amounts:
-            total += amt
-            cum_water.append(total)
-
-        plt.figure(figsize=(10, 5))
-        plt.plot(times_water, cum_water, marker="o", label="Выпито")
-        plt.axhline(y=data["water_goal"], color="r", linestyle="--", label="Норма воды")
-        plt.xlabel("Время")
-        plt.ylabel("Выпито воды (мл)")
-        plt.title("Прогресс по воде")
-        plt.legend()
-
-        buf_water = io.BytesIO()
-        plt.savefig(buf_water, format="png")
-        buf_water.seek(0)
-        plt.close()
-
-        file_water = types.BufferedInputFile(buf_water.getvalue(), filename="water_progress.png")
+        times_water = water_logs.timestamps + utc_offset
+        cum_water = np.cumsum(water_logs.values, dtype=np.float64)
+
+        png_water = await asyncio.to_thread(
+            render_progress_png,
+            times_water,
+            cum_water,
+            user.water_goal,
+            label="Выпито",
+            goal_label="Норма воды",
+            ylabel="Выпито воды (мл)",
+            title="Прогресс по воде",
+        )
+
+        file_water = types.BufferedInputFile(png_water, filename="water_progress.png")
         await message.answer_photo(photo=file_water, caption="График прогресса по воде")
     else:
         await message.answer("Нет данных для построения графика выпитой воды.")
 
     if food_logs or workout_logs:
-        events = []
-        for t, cal in food_logs:
-            events.append((t, cal))
-        for t, cal in workout_logs:
-            events.append((t, -cal))
-        events.sort(key=lambda x: x[0])
-
-        times = []
-        net_values = []
-        net = 0
-        for t, delta in events:
-            net += delta
-            times.append(t)
-            net_values.append(net)
-
-        plt.figure(figsize=(10, 5))
-        plt.plot(times, net_values, marker="o", label="Нетто калории")
-        plt.axhline(y=data["calorie_goal"], color="r", linestyle="--", label="Норма калорий")
-        plt.xlabel("Время")
-        plt.ylabel("Калории")
-        plt.title("Прогресс по калориям")
-        plt.legend()
-
-        buf_calories = io.BytesIO()
-        plt.savefig(buf_calories, format="png")
-        buf_calories.seek(0)
-        plt.close()
-
-        file_calories = types.BufferedInputFile(buf_calories.getvalue(), filename="calorie_progress.png")
+        times = np.concatenate((food_logs.timestamps, workout_logs.timestamps))
+        deltas = np.concatenate((food_logs.values, -workout_logs.values))
+        order = np.argsort(times, kind="stable")
+        times = times[order] + utc_offset
+        net_values = np.cumsum(deltas[order], dtype=np.float64)
+
+        png_calories = await asyncio.to_thread(
+            render_progress_png,
+            times,
+            net_values,
+            user.calorie_goal,
+            label="Нетто калории",
+            goal_label="Норма калорий",
+            ylabel="Калории",
+            title="Прогресс по калориям",
+        )
+
+        file_calories = types.BufferedInputFile(png_calories, filename="calorie_progress.png")
         await message.answer_photo(photo=file_calories, caption="График прогресса по калориям")
     else:
         await message.answer("Нет данных для построения графика сожженых калорий.")
@@ -569,9 +781,20 @@ async def set_bot_commands(bot: Bot):
     await bot.set_my_commands(commands)
 
 async def main():
+    global session
     print("Бот запущен!")
-    await set_bot_commands(bot)
-    await dp.start_polling(bot)
+    connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        flush_task = asyncio.create_task(flush_logs_periodically())
+        try:
+            await set_bot_commands(bot)
+            await dp.start_polling(bot)
+        finally:
+            flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await flush_task
+            await flush_logs()
+            await redis.aclose()
 
 if __name__ == "__main__":
     asyncio.run(main())